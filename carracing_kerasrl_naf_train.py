@@ -30,21 +30,23 @@ class CarRacingProcessor(Processor):
     Flappy-Bird.
     """
 
+    def __init__(self):
+        self.normalizer = StateBatchNormalizer()
+
     def process_observation(self, observation):
         """
         Takes an observation, resizes it and turns it into greyscale.
         """
         img = Image.fromarray(observation)
         img = img.resize(INPUT_SHAPE).convert('L')
-        processed_observation = np.array(img)
-        return processed_observation.astype('uint8')
+        processed_observation = np.asarray(img, dtype=np.uint8)
+        return processed_observation
 
     def process_state_batch(self, batch):
         """
-        Normalizes a batch of observations.
+        Normalizes a batch of observations into a reused buffer.
         """
-        processed_batch = batch.astype('float32') / 255.
-        return processed_batch
+        return self.normalizer(batch)
 
     def process_reward(self, reward):
         """
@@ -8,7 +8,6 @@ from gym_duckietown.wrappers import DiscreteWrapper
 from keras import models, layers, optimizers
 from rl.agents.dqn import DQNAgent
 from rl.policy import LinearAnnealedPolicy, BoltzmannQPolicy, EpsGreedyQPolicy
-from rl.memory import SequentialMemory
 from rl.core import Processor
 from rl.callbacks import FileLogger, ModelIntervalCheckpoint
 from kerasrl_extensions import *
@@ -32,21 +31,23 @@ class DuckieTownProcessor(Processor):
     Flappy-Bird.
     """
 
+    def __init__(self):
+        self.normalizer = StateBatchNormalizer()
+
     def process_observation(self, observation):
         """
         Takes an observation, resizes it and turns it into greyscale.
         """
         img = Image.fromarray(observation)
         img = img.resize(INPUT_SHAPE).convert('L')
-        processed_observation = np.array(img)
-        return processed_observation.astype('uint8')
+        processed_observation = np.asarray(img, dtype=np.uint8)
+        return processed_observation
 
     def process_state_batch(self, batch):
         """
-        Normalizes a batch of observations.
+        Normalizes a batch of observations into a reused buffer.
         """
-        processed_batch = batch.astype('float32') / 255.
-        return processed_batch
+        return self.normalizer(batch)
 
     def process_reward(self, reward):
         """
@@ -76,7 +77,7 @@ def main():
 
     # Finally, we configure and compile our agent. You can use every built-in Keras optimizer and
     # even the metrics!
-    memory = SequentialMemory(limit=1000000, window_length=WINDOW_LENGTH)
+    memory = RingBufferMemory(limit=1000000, window_length=WINDOW_LENGTH)
     processor = DuckieTownProcessor()
 
     # Select a policy. We use eps-greedy action selection, which means that a random action is selected
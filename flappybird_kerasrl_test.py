@@ -5,10 +5,10 @@ import gym
 import gym_ple
 from keras import optimizers
 from rl.agents.dqn import DQNAgent
-from rl.memory import SequentialMemory
 from rl.core import Processor
 import sys
-from flappybird_kerasrl_train import FlappyBirdProcessor, build_model
+from kerasrl_extensions import create_session, create_frozen_predict_function, RingBufferMemory
+from flappybird_kerasrl_train import FlappyBirdProcessor, MaxAndSkipEnv, build_model
 
 
 INPUT_SHAPE = (84, 84)
@@ -17,22 +17,30 @@ WINDOW_LENGTH = 4
 
 def main():
 
-    if len(sys.argv) != 2:
+    if len(sys.argv) < 2:
         print("Must provide weights file-name.")
         exit(0)
 
+    # XLA fuses each convolution with its bias and activation.
+    create_session(xla_jit=True)
+
     # Get the environment and extract the number of actions.
     environment_name = "FlappyBird-v0"
     environment = gym.make(environment_name)
+
+    # Weights are trained with frame-skipping. Older weight-files, like the ones in
+    # pretrained_models, were trained without it and need the "noframeskip" option.
+    if "noframeskip" not in sys.argv:
+        environment = MaxAndSkipEnv(environment)
     np.random.seed(666)
     nb_actions = environment.action_space.n
 
     # Build the model.
-    model = build_model((WINDOW_LENGTH,) + INPUT_SHAPE, nb_actions)
+    model = build_model(INPUT_SHAPE + (WINDOW_LENGTH,), nb_actions)
     print(model.summary())
 
-    # Create memory.
-    memory = SequentialMemory(limit=1000000, window_length=WINDOW_LENGTH) # TODO Why is this necessary?
+    # Create memory. It provides the channels-last window of recent observations.
+    memory = RingBufferMemory(limit=1000, window_length=WINDOW_LENGTH, channels_last=True)
 
     # Create the processor.
     processor = FlappyBirdProcessor()
@@ -44,13 +52,16 @@ def main():
         memory=memory,
         processor=processor,
         )
-    dqn.target_model = dqn.model # TODO Why is this necessary?
-    dqn.compile(optimizers.Adam(lr=.00025), metrics=['mae']) # TODO Why is this necessary?
+    # Compiling creates the target model as a clone of the model. load_weights updates both.
+    dqn.compile(optimizers.Adam(lr=.00025), metrics=['mae'])
 
     # Load the weights.
     weights_filename = sys.argv[1]
     dqn.load_weights(weights_filename)
 
+    # Predict with a frozen copy of the model. It only holds the weights needed for inference.
+    dqn.model.predict_on_batch = create_frozen_predict_function(dqn.model, xla_jit=True)
+
     # Test the agent.
     dqn.test(environment, nb_episodes=10, visualize=True)
 
@@ -1,13 +1,13 @@
 import warnings
 warnings.filterwarnings("ignore")
-from PIL import Image
+import cv2
 import numpy as np
+import functools
 import gym
 import gym_ple
 from keras import models, layers, optimizers
-from rl.agents.dqn import DQNAgent
+from keras import backend as K
 from rl.policy import LinearAnnealedPolicy, BoltzmannQPolicy, EpsGreedyQPolicy
-from rl.memory import SequentialMemory
 from rl.core import Processor
 from rl.callbacks import FileLogger, ModelIntervalCheckpoint
 from kerasrl_extensions import *
@@ -15,6 +15,7 @@ from kerasrl_extensions import *
 
 INPUT_SHAPE = (84, 84)
 WINDOW_LENGTH = 4
+NB_ENVIRONMENTS = 4
 
 
 class FlappyBirdProcessor(Processor):
@@ -25,42 +26,105 @@ class FlappyBirdProcessor(Processor):
 
     def process_observation(self, observation):
         """
-        Takes an observation, resizes it and turns it into greyscale.
+        Takes an observation, turns it into greyscale and resizes it.
+        Greyscale comes first so that the resize only touches one channel.
         """
-        img = Image.fromarray(observation)
-        img = img.resize(INPUT_SHAPE).convert('L')
-        processed_observation = np.array(img)
-        return processed_observation.astype('uint8')
+        grey = cv2.cvtColor(observation, cv2.COLOR_RGB2GRAY)
+        return cv2.resize(grey, INPUT_SHAPE, interpolation=cv2.INTER_AREA)
 
     def process_state_batch(self, batch):
         """
-        Normalizes a batch of observations.
+        Keeps the batch as uint8. Normalization happens inside the model,
+        which keeps the data that is fed to the network small.
         """
-        processed_batch = batch.astype('float32') / 255.
-        return processed_batch
+        return batch
 
     def process_reward(self, reward):
         """
-        Clips the rewards.
+        Clips the rewards. Plain Python is faster than np.clip for scalars.
         """
-        return np.clip(reward, -1., 1.)
+        reward = float(reward)
+        return 1. if reward > 1. else (-1. if reward < -1. else reward)
+
+
+class MaxAndSkipEnv(gym.Wrapper):
+    """
+    Repeats every action for a number of frames. Returns the elementwise
+    maximum of the last two frames and the summed reward. This way only
+    every skip-th frame has to be preprocessed.
+    """
+
+    def __init__(self, env, skip=4):
+        gym.Wrapper.__init__(self, env)
+        self.skip = skip
+
+    def step(self, action):
+        total_reward = 0.
+        previous_observation = None
+        observation = None
+        for _ in range(self.skip):
+            previous_observation = observation
+            observation, reward, done, info = self.env.step(action)
+            total_reward += reward
+            if done:
+                break
+
+        if previous_observation is not None:
+            observation = np.maximum(previous_observation, observation)
+        return observation, total_reward, done, info
+
+
+class FlappyBirdObservationWrapper(gym.ObservationWrapper):
+    """
+    Preprocesses the observations inside the environment. In a vectorized
+    environment this moves the preprocessing into the worker processes.
+    """
+
+    def __init__(self, env):
+        gym.ObservationWrapper.__init__(self, env)
+        self.processor = FlappyBirdProcessor()
+        self.observation_space = gym.spaces.Box(low=0, high=255, shape=INPUT_SHAPE, dtype=np.uint8)
+
+    def observation(self, observation):
+        return self.processor.process_observation(observation)
+
+
+def create_environment(environment_name):
+    """
+    Creates a single environment with frame-skipping and preprocessed observations.
+    """
+    environment = gym.make(environment_name)
+    environment = MaxAndSkipEnv(environment)
+    environment = FlappyBirdObservationWrapper(environment)
+    environment = TerminalObservationWrapper(environment)
+    return environment
 
 
 def main():
 
-    # Get the environment and extract the number of actions.
+    # Get the environments and extract the number of actions. The environments
+    # are stepped in parallel worker-processes.
     environment_name = "FlappyBird-v0"
-    environment = gym.make(environment_name)
+    environment = gym.vector.AsyncVectorEnv(
+        [functools.partial(create_environment, environment_name) for _ in range(NB_ENVIRONMENTS)])
     np.random.seed(666)
-    nb_actions = environment.action_space.n
+    nb_actions = environment.single_action_space.n
+
+    # XLA fuses each convolution with its bias and activation. The session is created
+    # after the worker-processes have been forked.
+    create_session(xla_jit=True)
 
     # Build the model.
-    model = build_model((WINDOW_LENGTH,) + INPUT_SHAPE, nb_actions)
+    model = build_model(INPUT_SHAPE + (WINDOW_LENGTH,), nb_actions)
     print(model.summary())
 
     # Finally, we configure and compile our agent. You can use every built-in Keras optimizer and
     # even the metrics!
-    memory = SequentialMemory(limit=1000000, window_length=WINDOW_LENGTH)
+    # Note: All step-counts are steps of the vectorized environment. Each of them yields
+    # NB_ENVIRONMENTS transitions. We keep one memory per environment.
+    memory = VectorizedMemory(
+        [RingBufferMemory(limit=1000000 // NB_ENVIRONMENTS, window_length=WINDOW_LENGTH, channels_last=True)
+         for _ in range(NB_ENVIRONMENTS)])
     processor = FlappyBirdProcessor()
 
     # Select a policy. We use eps-greedy action selection, which means that a random action is selected
@@ -69,7 +133,7 @@ def main():
     # (low eps). We also set a dedicated eps value that is used during testing. Note that we set it to 0.05
     # so that the agent still performs some random actions. This ensures that the agent cannot get stuck.
     policy = LinearAnnealedPolicy(EpsGreedyQPolicy(), attr='eps', value_max=1., value_min=.1, value_test=.05,
-                                  nb_steps=1000000)
+                                  nb_steps=1000000 // NB_ENVIRONMENTS)
 
     # The trade-off between exploration and exploitation is difficult and an on-going research topic.
     # If you want, you can experiment with the parameters or use a different policy. Another popular one
@@ -77,11 +141,19 @@ def main():
     # policy = BoltzmannQPolicy(tau=1.)
     # Feel free to give it a try!
 
-    dqn = DQNAgent(model=model, nb_actions=nb_actions, policy=policy, memory=memory,
-                   processor=processor, nb_steps_warmup=50000, gamma=.99, target_model_update=10000,
-                   train_interval=4, delta_clip=1.)
+    # Actions are selected with an int8-quantized copy of the model, which is refreshed on
+    # every update of the target model.
+    dqn = QuantizedDQNAgent(model=model, nb_actions=nb_actions, policy=policy, memory=memory,
+                           processor=processor, nb_steps_warmup=50000 // NB_ENVIRONMENTS, gamma=.99,
+                           target_model_update=10000 // NB_ENVIRONMENTS, train_interval=max(1, 4 // NB_ENVIRONMENTS),
+                           delta_clip=1.)
     dqn.compile(optimizers.Adam(lr=.00025), metrics=['mae'])
 
+    # Rollouts and target-computation call predict_on_batch with different batch-sizes.
+    # A single backend-function per model serves all of them.
+    dqn.model.predict_on_batch = create_predict_function(dqn.model)
+    dqn.target_model.predict_on_batch = create_predict_function(dqn.target_model)
+
     weights_filename = 'dqn_{}_weights.h5f'.format(environment_name)
 
     # Okay, now it's time to learn something! We capture the interrupt exception so that training
@@ -91,25 +163,28 @@ def main():
     callbacks = [ModelIntervalCheckpoint(checkpoint_weights_filename, interval=250000)]
     callbacks += [TensorboardCallback()]
     callbacks += [FileLogger(log_filename, interval=100)]
-    dqn.fit(environment, callbacks=callbacks, nb_steps=1750000, log_interval=10000)
+    fit_vectorized(dqn, environment, callbacks=callbacks, nb_steps=1750000 // NB_ENVIRONMENTS,
+                   log_interval=10000 // NB_ENVIRONMENTS)
+    environment.close()
 
     # After training is done, we save the final weights one more time.
     dqn.save_weights(weights_filename, overwrite=True)
 
-    # Finally, evaluate our algorithm for 10 episodes.
-    dqn.test(environment, nb_episodes=10, visualize=False)
+    # Finally, evaluate our algorithm for 10 episodes. Testing runs on a single environment,
+    # which requires a plain memory.
+    dqn.memory = RingBufferMemory(limit=1000, window_length=WINDOW_LENGTH, channels_last=True)
+    dqn.test(MaxAndSkipEnv(gym.make(environment_name)), nb_episodes=10, visualize=False)
 
 def build_model(input_shape, actions):
-    model = models.Sequential()
-    model.add(layers.Permute((2, 3, 1), input_shape=input_shape))
-    model.add(layers.Convolution2D(32, (8, 8), strides=(4, 4), activation="relu"))
-    model.add(layers.Convolution2D(64, (4, 4), strides=(2, 2), activation="relu"))
-    model.add(layers.Convolution2D(64, (3, 3), strides=(1, 1), activation="relu"))
-    model.add(layers.Flatten())
-    model.add(layers.Dense(512, activation="relu"))
-    model.add(layers.Dense(actions, activation="linear"))
-    return model
-
+    inputs = layers.Input(shape=input_shape, dtype="uint8")
+    x = layers.Lambda(lambda x: K.cast(x, "float32") / 255.)(inputs)
+    x = layers.Convolution2D(32, (8, 8), strides=(4, 4), activation="relu")(x)
+    x = layers.Convolution2D(64, (4, 4), strides=(2, 2), activation="relu")(x)
+    x = layers.Convolution2D(64, (3, 3), strides=(1, 1), activation="relu")(x)
+    x = layers.Flatten()(x)
+    x = layers.Dense(512, activation="relu")(x)
+    outputs = layers.Dense(actions, activation="linear")(x)
+    return models.Model(inputs, outputs)
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,62 @@
-from rl.callbacks import Callback
+from rl.callbacks import Callback, CallbackList
+from rl.memory import Memory, Experience
+from rl.agents.dqn import DQNAgent
 import tensorflow as tf
-from collections import deque
+from keras import backend as K
+import gym
 import numpy as np
+import os
 import time
 import datetime
 
+
+class RunningMean:
+    """
+    Mean over the most recent values. The values are kept in a preallocated
+    ring-buffer and the sum is updated incrementally.
+    """
+
+    def __init__(self, length):
+        self.values = np.zeros(length, dtype=np.float64)
+        self.index = 0
+        self.count = 0
+        self.sum = 0.
+
+    def append(self, value):
+        self.sum += value - self.values[self.index]
+        self.values[self.index] = value
+        self.index = (self.index + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+
+    def mean(self):
+        return self.sum / self.count
+
+    def __len__(self):
+        return self.count
+
+
+class StateBatchNormalizer:
+    """
+    Scales uint8 state-batches to float32 in [0, 1] without allocating.
+
+    Keeps two buffers per batch-shape and alternates between them, because
+    keras-rl's backward pass processes state0 and state1 before using
+    either. A result is valid until the next-but-one call with the same
+    shape.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def __call__(self, batch):
+        buffers = self.buffers.get(batch.shape)
+        if buffers is None:
+            buffers = [np.empty(batch.shape, dtype=np.float32) for _ in range(2)]
+            self.buffers[batch.shape] = buffers
+        buffers.reverse()
+        return np.multiply(batch, np.float32(1. / 255.), out=buffers[0])
+
+
 class TensorboardCallback(Callback):
     """
     Provides logging in TensorBoard.
@@ -12,12 +64,12 @@ class TensorboardCallback(Callback):
 
     def __init__(self, path="tensorboard", log_interval=1000, reward_buffer_length=10000, episode_duration_buffer_length=10000):
         self.log_interval = log_interval
+        self.episode_duration_buffer_length = episode_duration_buffer_length
 
         self.iterations = 0
 
         self.running_data = {}
-        self.running_data["reward"] = deque([], maxlen=reward_buffer_length)
-        #self.running_data["episode_duration"] = deque([], maxlen=episode_duration_buffer_length)
+        self.running_data["reward"] = RunningMean(reward_buffer_length)
 
         self.tensorboard_writer = tf.summary.FileWriter(path, flush_secs=5)
 
@@ -28,10 +80,8 @@ class TensorboardCallback(Callback):
         self.running_data["reward"].append(logs["reward"])
 
         if self.iterations % self.log_interval == 0:
-            for key, values in self.running_data.items():
-                if len(values) > 0:
-                    mean = np.mean(values)
-                    self._log_scalar(key + "-mean", mean, self.iterations)
+            scalars = [(key + "-mean", values.mean()) for key, values in self.running_data.items() if len(values) > 0]
+            self._log_scalars(scalars, self.iterations)
 
         self.iterations += 1
 
@@ -39,18 +89,16 @@ class TensorboardCallback(Callback):
         """
         Logs the duration of the episode.
         """
-        #self.running_data["episode_duration"].append(logs["nb_episode_steps"])
-
         for key, value in logs.items():
             if key not in self.running_data.keys():
-                self.running_data[key] = []
+                self.running_data[key] = RunningMean(self.episode_duration_buffer_length)
             self.running_data[key].append(logs[key])
 
-    def _log_scalar(self, tag, value, step):
+    def _log_scalars(self, scalars, step):
         """
-        Accesses tensorbord to log a value.
+        Accesses tensorbord to log a list of tag-value-pairs in one summary.
         """
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value)])
+        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value) for tag, value in scalars])
         self.tensorboard_writer.add_summary(summary, step)
 
 
@@ -66,3 +114,441 @@ class TrainingDurationEstimatorCallback(Callback):
 
         #elapsed_time = time.time -
         string = str(datetime.timedelta(seconds=666))
+
+
+def create_session_config(xla_jit=False, cpu_only=False, nb_threads=None):
+    """
+    Creates the configuration for TensorFlow-sessions.
+
+    With xla_jit the graph is compiled with XLA, which fuses small
+    operations into fewer kernels. With cpu_only no GPU is used, which is
+    faster for tiny models. nb_threads limits the threads per operation
+    and the number of operations running in parallel.
+    """
+    config = tf.ConfigProto()
+    if cpu_only:
+        config.device_count["GPU"] = 0
+    if nb_threads is not None:
+        config.intra_op_parallelism_threads = nb_threads
+        config.inter_op_parallelism_threads = nb_threads
+    if xla_jit:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+
+def create_session(**kwargs):
+    """
+    Creates a TensorFlow-session and registers it with Keras. Takes the
+    arguments of create_session_config.
+
+    With xla_jit and cpu_only, XLA's auto-clustering of CPU operations is
+    enabled via TF_XLA_FLAGS. TensorFlow reads the flags only once, so this
+    must be the first session of the process.
+    """
+    if kwargs.get("xla_jit") and kwargs.get("cpu_only"):
+        xla_flags = os.environ.get("TF_XLA_FLAGS", "").split()
+        if "--tf_xla_cpu_global_jit" not in xla_flags:
+            os.environ["TF_XLA_FLAGS"] = " ".join(xla_flags + ["--tf_xla_cpu_global_jit"])
+    session = tf.Session(config=create_session_config(**kwargs))
+    K.set_session(session)
+    return session
+
+
+def create_predict_function(model):
+    """
+    Returns a function that does predictions with one backend-function.
+    It accepts any batch-size and skips the input-checks of
+    predict_on_batch.
+    """
+    function = K.function([model.input], [model.output])
+
+    def predict_on_batch(batch):
+        return function([batch])[0]
+
+    return predict_on_batch
+
+
+def create_frozen_predict_function(model, **kwargs):
+    """
+    Freezes the weights of a model into constants and returns a function
+    that does predictions on the frozen graph. Optimizer-slots and other
+    training-only nodes are dropped. Takes the arguments of
+    create_session_config.
+    """
+    session = K.get_session()
+    output_name = model.output.op.name
+    graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), [output_name])
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=[output_name])
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+    frozen_session = tf.Session(graph=graph, config=create_session_config(**kwargs))
+    input_tensor = graph.get_tensor_by_name(model.input.name)
+    output_tensor = graph.get_tensor_by_name(model.output.name)
+
+    def predict_on_batch(batch):
+        return frozen_session.run(output_tensor, feed_dict={input_tensor: batch})
+
+    return predict_on_batch
+
+
+class QuantizedDQNAgent(DQNAgent):
+    """
+    DQN-agent that selects actions with an int8-quantized TFLite-copy of
+    the model. Training still uses the float32 model.
+
+    The quantized copy is rebuilt after every hard update of the target
+    model. It is calibrated with states sampled from the replay memory.
+    Until then, and during testing, actions are selected with the float32
+    model.
+    """
+
+    def __init__(self, *args, nb_calibration_samples=100, **kwargs):
+        DQNAgent.__init__(self, *args, **kwargs)
+        self.nb_calibration_samples = nb_calibration_samples
+        self.interpreter = None
+
+    def backward(self, reward, terminal):
+        """
+        Trains and refreshes the quantized model after hard target-updates.
+        """
+        metrics = DQNAgent.backward(self, reward, terminal)
+        if self.training and self.target_model_update >= 1 and self.step > self.nb_steps_warmup and self.step % self.target_model_update == 0:
+            self.quantize_model()
+        return metrics
+
+    def quantize_model(self):
+        """
+        Converts the model to an int8 TFLite-model.
+        """
+        def representative_dataset():
+            for experience in self.memory.sample(self.nb_calibration_samples):
+                yield [self.process_state_batch([experience.state0])]
+
+        converter = tf.lite.TFLiteConverter.from_session(K.get_session(), [self.model.input], [self.model.output])
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        self.interpreter = tf.lite.Interpreter(model_content=converter.convert())
+        self.interpreter.allocate_tensors()
+        self._cache_interpreter_details()
+
+    def _cache_interpreter_details(self):
+        """
+        Caches the tensor-details of the interpreter, which are costly to query.
+        """
+        input_details = self.interpreter.get_input_details()[0]
+        self.interpreter_input_index = input_details["index"]
+        self.interpreter_input_shape = tuple(input_details["shape"])
+        self.interpreter_input_dtype = input_details["dtype"]
+        self.interpreter_output_index = self.interpreter.get_output_details()[0]["index"]
+
+    def compute_batch_q_values(self, state_batch):
+        """
+        Computes the q-values with the quantized model during training if
+        there is one. Testing always uses the float32 model.
+        """
+        if self.interpreter is None or not self.training:
+            return DQNAgent.compute_batch_q_values(self, state_batch)
+
+        batch = self.process_state_batch(state_batch)
+        if self.interpreter_input_shape != batch.shape:
+            self.interpreter.resize_tensor_input(self.interpreter_input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self._cache_interpreter_details()
+        self.interpreter.set_tensor(self.interpreter_input_index, batch.astype(self.interpreter_input_dtype, copy=False))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.interpreter_output_index)
+
+
+class RingBufferMemory(Memory):
+    """
+    Replay memory that keeps observations in one preallocated array.
+
+    Each observation is stored once. On sampling, the states are assembled
+    from the stored observations with a single vectorized gather. Follows
+    the sampling semantics of keras-rl's SequentialMemory. Actions must be
+    discrete.
+
+    With channels_last the observations of a state are stacked along the
+    last axis, which matches the layout of convolutional layers.
+    """
+
+    def __init__(self, limit, channels_last=False, **kwargs):
+        Memory.__init__(self, **kwargs)
+        self.limit = limit
+        self.channels_last = channels_last
+        self.observations = None
+        self.actions = np.empty(limit, dtype="uint8")
+        self.rewards = np.empty(limit, dtype="float32")
+        self.terminals = np.empty(limit, dtype="bool")
+        self.next_index = 0
+        self.length = 0
+
+    def append(self, observation, action, reward, terminal, training=True):
+        """
+        Stores a transition. The observation array is allocated lazily.
+        """
+        Memory.append(self, observation, action, reward, terminal, training=training)
+        if not training:
+            return
+
+        if self.observations is None:
+            observation = np.asarray(observation)
+            self.observations = np.empty((self.limit,) + observation.shape, dtype=observation.dtype)
+        self.observations[self.next_index] = observation
+        self.actions[self.next_index] = action
+        self.rewards[self.next_index] = reward
+        self.terminals[self.next_index] = terminal
+        self.next_index = (self.next_index + 1) % self.limit
+        self.length = min(self.length + 1, self.limit)
+
+    def sample(self, batch_size, batch_idxs=None):
+        """
+        Samples a batch of experiences.
+        """
+        low, high = self.window_length, self.nb_entries - 1
+        if batch_idxs is None:
+            batch_idxs = np.random.randint(low, high, size=batch_size)
+        batch_idxs = np.asarray(batch_idxs) + 1
+
+        # Resample transitions that start directly after a terminal.
+        invalid = self.terminals[self._physical_index(batch_idxs - 2)]
+        while np.any(invalid):
+            batch_idxs[invalid] = np.random.randint(low, high, size=np.sum(invalid)) + 1
+            invalid = self.terminals[self._physical_index(batch_idxs - 2)]
+
+        # Gather the observations of state0 and state1 at once.
+        positions = batch_idxs[:, None] + np.arange(-self.window_length, 1)
+        frames = self.observations[self._physical_index(positions)]
+
+        # Zero the observations that belong to previous episodes.
+        if not self.ignore_episode_boundaries:
+            terminals = self.terminals[self._physical_index(positions[:, :self.window_length - 1] - 1)]
+            invalid = np.logical_or.accumulate(terminals[:, ::-1], axis=1)[:, ::-1]
+            frames[:, :self.window_length - 1][invalid] = 0
+
+        if self.channels_last:
+            frames = np.moveaxis(frames, 1, -1)
+        state0_batch = frames[..., :-1] if self.channels_last else frames[:, :-1]
+        state1_batch = frames[..., 1:] if self.channels_last else frames[:, 1:]
+        transition_idxs = self._physical_index(batch_idxs - 1)
+        action_batch = self.actions[transition_idxs]
+        reward_batch = self.rewards[transition_idxs]
+        terminal1_batch = self.terminals[transition_idxs]
+
+        return [
+            Experience(state0=state0, action=action, reward=reward, state1=state1, terminal1=terminal1)
+            for state0, action, reward, state1, terminal1
+            in zip(state0_batch, action_batch, reward_batch, state1_batch, terminal1_batch)
+        ]
+
+    def get_recent_state(self, current_observation):
+        """
+        Returns the recent state, stacked along the last axis with channels_last.
+        """
+        state = Memory.get_recent_state(self, current_observation)
+        if self.channels_last:
+            state = np.stack(state, axis=-1)
+        return state
+
+    def _physical_index(self, idxs):
+        """
+        Maps indices relative to the oldest entry to indices into the arrays.
+        """
+        return (self.next_index - self.length + idxs) % self.limit
+
+    @property
+    def nb_entries(self):
+        return self.length
+
+    def get_config(self):
+        config = Memory.get_config(self)
+        config["limit"] = self.limit
+        config["channels_last"] = self.channels_last
+        return config
+
+
+class TerminalObservationWrapper(gym.Wrapper):
+    """
+    Copies the last observation of an episode into the info. Vectorized
+    environments reset finished environments themselves and would
+    otherwise lose it.
+    """
+
+    def step(self, action):
+        observation, reward, done, info = self.env.step(action)
+        if done:
+            info = dict(info)
+            info["terminal_observation"] = observation
+        return observation, reward, done, info
+
+
+class VectorizedMemory(Memory):
+    """
+    Keeps one memory per environment of a vectorized environment.
+
+    Observations, actions, rewards and terminals are appended as batches with
+    one entry per environment. Samples are drawn from all memories. The
+    windows for action selection are tracked by fit_vectorized.
+    """
+
+    def __init__(self, memories):
+        Memory.__init__(self, window_length=memories[0].window_length)
+        self.memories = memories
+        self.channels_last = getattr(memories[0], "channels_last", False)
+
+    def append(self, observations, actions, rewards, terminals, training=True):
+        """
+        Appends one transition to the memory of each environment.
+        """
+        for memory, observation, action, reward, terminal in zip(self.memories, observations, actions, rewards, terminals):
+            memory.append(observation, action, reward, terminal, training=training)
+
+    def sample(self, batch_size, batch_idxs=None):
+        """
+        Samples a batch of experiences spread across all memories.
+        """
+        memory_indices = np.random.randint(len(self.memories), size=batch_size)
+        counts = np.bincount(memory_indices, minlength=len(self.memories))
+        experiences = []
+        for memory, count in zip(self.memories, counts):
+            if count > 0:
+                experiences.extend(memory.sample(int(count)))
+        return experiences
+
+    @property
+    def nb_entries(self):
+        return sum(memory.nb_entries for memory in self.memories)
+
+    def get_config(self):
+        config = Memory.get_config(self)
+        config["memories"] = [memory.get_config() for memory in self.memories]
+        return config
+
+
+def fit_vectorized(agent, environment, nb_steps, callbacks=[], log_interval=10000):
+    """
+    Trains a keras-rl agent on a vectorized gym-environment.
+
+    keras-rl's fit only supports a single environment. This loop does a
+    batched forward pass for all environments and feeds the transitions
+    into the agent's backward pass. The agent must use a VectorizedMemory
+    and the environments must be wrapped in a TerminalObservationWrapper.
+    Steps are counted in steps of the vectorized environment.
+
+    The backward pass for the transitions of one step runs while the
+    environments compute the next step.
+    """
+    nb_environments = environment.num_envs
+
+    callbacks = CallbackList(callbacks)
+    if hasattr(callbacks, "set_model"):
+        callbacks.set_model(agent)
+    else:
+        callbacks._set_model(agent)
+    callbacks._set_env(environment)
+    callbacks.on_train_begin()
+
+    agent.training = True
+    agent._on_train_begin()
+    agent.step = 0
+
+    # Keeps track of the recent observations of each environment. The replay
+    # memory is only updated in the deferred backward pass.
+    recent_memories = [Memory(window_length=agent.memory.window_length) for _ in range(nb_environments)]
+
+    episodes = np.arange(nb_environments)
+    episode_rewards = np.zeros(nb_environments)
+    episode_steps = np.zeros(nb_environments, dtype="int64")
+    next_episode = nb_environments
+    nb_transitions = 0
+    for episode in episodes:
+        callbacks.on_episode_begin(episode)
+
+    def backward(observations, actions, rewards, dones, infos):
+        """
+        Stores the transitions of one step, trains and does the logging.
+        """
+        nonlocal next_episode, nb_transitions
+
+        agent.recent_observation = observations
+        agent.recent_action = actions
+        metrics = agent.backward(rewards, terminal=dones)
+
+        # Like keras-rl's fit, store the last observation of an episode with a
+        # transition of its own, so that the next episode starts cleanly.
+        for index in np.flatnonzero(dones):
+            agent.memory.memories[index].append(infos[index]["terminal_observation"], 0, 0., False)
+
+        for index in range(nb_environments):
+            episode_rewards[index] += rewards[index]
+            episode_steps[index] += 1
+            nb_transitions += 1
+            step_logs = {
+                "action": actions[index],
+                "observation": observations[index],
+                "reward": rewards[index],
+                "metrics": metrics,
+                "episode": episodes[index],
+                "info": {},
+            }
+            callbacks.on_step_end(nb_transitions, step_logs)
+
+            if dones[index]:
+                episode_logs = {
+                    "episode_reward": episode_rewards[index],
+                    "nb_episode_steps": episode_steps[index],
+                    "nb_steps": nb_transitions,
+                }
+                callbacks.on_episode_end(episodes[index], episode_logs)
+                episodes[index] = next_episode
+                next_episode += 1
+                episode_rewards[index] = 0.
+                episode_steps[index] = 0
+                callbacks.on_episode_begin(episodes[index])
+
+        agent.step += 1
+
+        if agent.step % log_interval == 0:
+            nb_episodes = next_episode - nb_environments
+            print("Step {}/{}: {} transitions, {} episodes.".format(agent.step, nb_steps, nb_transitions, nb_episodes))
+
+    did_abort = False
+    try:
+        observations = environment.reset()
+        previous_transitions = None
+        for _ in range(nb_steps):
+
+            # Select one action per environment with a single forward pass.
+            states = [memory.get_recent_state(observation) for memory, observation in zip(recent_memories, observations)]
+            if agent.memory.channels_last:
+                states = [np.stack(state, axis=-1) for state in states]
+            q_values = agent.compute_batch_q_values(states)
+            actions = np.array([agent.policy.select_action(q_values=q) for q in q_values])
+
+            # Step all environments. Finished environments are reset automatically.
+            # Meanwhile, store the previous transitions and train.
+            environment.step_async(actions)
+            if previous_transitions is not None:
+                backward(*previous_transitions)
+            observations_next, rewards, dones, infos = environment.step_wait()
+            if agent.processor is not None:
+                rewards = np.array([agent.processor.process_reward(reward) for reward in rewards])
+
+            for memory, observation, action, reward, done, info in zip(recent_memories, observations, actions, rewards, dones, infos):
+                memory.append(observation, action, reward, done)
+                if done:
+                    memory.append(info["terminal_observation"], 0, 0., False)
+            previous_transitions = (observations, actions, rewards, dones, infos)
+            observations = observations_next
+
+        if previous_transitions is not None:
+            backward(*previous_transitions)
+
+    except KeyboardInterrupt:
+        # We catch keyboard interrupts here so that training can be be safely aborted.
+        did_abort = True
+
+    callbacks.on_train_end(logs={"did_abort": did_abort})
+    agent._on_train_end()
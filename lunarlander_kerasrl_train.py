@@ -1,11 +1,11 @@
 import numpy as np
+from numba import njit
 import gym
 from keras.models import Sequential
 from keras.layers import Dense, Activation, Flatten
 from keras.optimizers import Adam
 from rl.agents.dqn import DQNAgent
 from rl.policy import BoltzmannQPolicy, LinearAnnealedPolicy, EpsGreedyQPolicy
-from rl.memory import SequentialMemory
 from rl.callbacks import ModelIntervalCheckpoint
 from kerasrl_extensions import *
 import sys
@@ -15,8 +15,40 @@ import os
 ENV_NAME = "LunarLander-v2"
 datetime_string = datetime.datetime.now().strftime("%Y%m%d-%H%M")
 
+
+@njit(cache=True)
+def boltzmann_sample(q_values, tau, uniform_sample):
+    """
+    Samples an action from the Boltzmann-distribution over the q-values.
+    """
+    exp_values = np.exp((q_values - q_values.max()) / tau)
+    probabilities = exp_values / exp_values.sum()
+    cumulative_probability = 0.
+    for action in range(probabilities.size):
+        cumulative_probability += probabilities[action]
+        if uniform_sample < cumulative_probability:
+            return action
+    return probabilities.size - 1
+
+
+class NumbaBoltzmannQPolicy(BoltzmannQPolicy):
+    """
+    Boltzmann-policy that samples the action in a Numba-compiled function.
+    Subtracts the maximum q-value instead of clipping to keep exp stable.
+    """
+
+    def select_action(self, q_values):
+        assert q_values.ndim == 1
+        return boltzmann_sample(q_values.astype("float64"), self.tau, np.random.random())
+
+
 def main():
 
+    # The model is tiny. On the GPU, kernel-launches would dominate each step, so we
+    # stay on a single CPU-thread and leave the other cores to the environment.
+    # XLA fuses the layers into fewer kernels.
+    create_session(xla_jit=True, cpu_only=True, nb_threads=1)
+
     nb_steps = 100000
 
     # Create environment and model.
@@ -27,8 +59,8 @@ def main():
 
     # Finally, we configure and compile our agent. You can use every built-in Keras optimizer and
     # even the metrics!
-    memory = SequentialMemory(limit=nb_steps // 10, window_length=1)
-    policy = BoltzmannQPolicy()
+    memory = RingBufferMemory(limit=nb_steps // 10, window_length=1)
+    policy = NumbaBoltzmannQPolicy()
 
     #policy = LinearAnnealedPolicy(
     #    EpsGreedyQPolicy(),